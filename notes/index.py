@@ -0,0 +1,253 @@
+"""
+Cache of parsed records, stored in a sqlite database in the data directory.
+
+Reading and parsing every record dominates the runtime of the query commands, so the yaml
+data of each file is kept in the index along with the file's mtime and size. Only records which were
+added or changed since the last query are parsed again. The index can be deleted at any time;
+it will be rebuilt on the next query.
+"""
+import base64
+import contextlib
+import datetime
+import json
+import os
+import pathlib
+import sqlite3
+from typing import Iterable, Iterator, Optional
+
+from .parser import Record, parse_records, read_record, read_records, extract_record, record_type, file_id_from_name, iter_files, TIMEZONE
+
+
+INDEX_NAME = ".index.sqlite3"
+
+# Bump this when the schema or the cached data changes, so existing indexes are rebuilt.
+VERSION = 5
+
+
+def connect(data_dir: pathlib.Path) -> sqlite3.Connection:
+    path = data_dir / INDEX_NAME
+    try:
+        return open_index(path)
+    except sqlite3.OperationalError:
+        # e.g. locked by another process, or unopenable. The file may be fine, so keep it.
+        raise
+    except sqlite3.DatabaseError:
+        # e.g. a corrupt file, or a conflicted copy from a sync service. The index is only a
+        # cache, so start a new one.
+        for suffix in ("", "-journal", "-wal", "-shm"):
+            pathlib.Path(f"{path}{suffix}").unlink(missing_ok=True)
+        return open_index(path)
+
+
+def open_index(path: pathlib.Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+    except sqlite3.DatabaseError:
+        conn.close()
+        raise
+    if version != VERSION:
+        conn.executescript(f"""
+            DROP TABLE IF EXISTS records;
+            CREATE TABLE records (
+                path TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                type TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                event TEXT,
+                raw_data TEXT NOT NULL,
+                completed INTEGER NOT NULL,
+                -- Date after which the record is no longer relevant, if known.
+                irrelevant_after TEXT
+            );
+            CREATE INDEX records_file_id ON records (file_id);
+            CREATE INDEX records_name ON records (name);
+            PRAGMA user_version = {VERSION};
+        """)
+    return conn
+
+
+def placeholders(values: list) -> str:
+    return ", ".join("?" * len(values))
+
+
+def suffixes(types: Optional[list[str]]) -> tuple[str, ...]:
+    if types is None:
+        return (".yaml", ".md")
+    return tuple(f"-{type}{ext}" for type in types for ext in (".yaml", ".md"))
+
+
+def refresh(conn: sqlite3.Connection, data_dir: pathlib.Path, types: Optional[list[str]]=None):
+    """
+    Parse records of the given types (default all) which were added or modified since the last
+    refresh, and drop deleted ones.
+
+    File names end with the record type, so other records are skipped without a stat() call.
+    Paths are stored relative to the data directory, so the index survives moving it around.
+    """
+    if types is None:
+        query, params = "SELECT path, mtime_ns, size FROM records", ()
+    else:
+        query, params = f"SELECT path, mtime_ns, size FROM records WHERE type IN ({placeholders(types)})", types
+    indexed = {path: (mtime_ns, size) for path, mtime_ns, size in conn.execute(query, params)}
+    stale = []
+    for entry in iter_files(data_dir, suffixes(types)):
+        relative = os.path.relpath(entry.path, data_dir)
+        stat = entry.stat()
+        # The size catches edits within the mtime resolution of coarse filesystems.
+        key = (stat.st_mtime_ns, stat.st_size)
+        if indexed.pop(relative, None) != key:
+            stale.append((relative, key, entry.name, entry.path))
+    rows = []
+    for (relative, (mtime_ns, size), name, path), record in zip(stale, read_records([path for *_, path in stale])):
+        if record is not None:
+            try:
+                rows.append(row(relative, mtime_ns, size, name, path, *record))
+                continue
+            except Exception as e:
+                # e.g. a file name without the record type.
+                print(f"Failed to parse {path}: {e}")
+        indexed[relative] = None
+    with conn:
+        conn.executemany("DELETE FROM records WHERE path = ?", [(path,) for path in indexed])
+        conn.executemany(INSERT, rows)
+
+
+INSERT = "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+
+def row(relative: str, mtime_ns: int, size: int, name: str, path: str, event: str, raw_data: dict) -> tuple:
+    return (relative, name, mtime_ns, size, record_type(name), file_id_from_name(name), event,
+            dump_data(raw_data), bool(raw_data.get("completed")),
+            irrelevant_after(path, event, raw_data))
+
+
+# The yaml data is stored as JSON rather than pickled, since anyone who can write to the
+# (often synced or shared) data directory could otherwise run code when it is loaded. Values
+# JSON has no type for are stored as single key objects, tagged with one of these keys.
+TAGS = {
+    "$datetime": (datetime.datetime, datetime.datetime.isoformat, datetime.datetime.fromisoformat),
+    "$date": (datetime.date, datetime.date.isoformat, datetime.date.fromisoformat),
+    "$bytes": (bytes, lambda b: base64.b64encode(b).decode(), base64.b64decode),
+    "$set": (set, lambda s: [encode(v) for v in s], lambda values: {decode(v) for v in values}),
+    "$tuple": (tuple, lambda t: [encode(v) for v in t], lambda values: tuple(decode(v) for v in values)),
+    # Dicts with keys other than strings, or which would be mistaken for a tag.
+    "$items": (dict, lambda d: [[encode(k), encode(v)] for k, v in d.items()],
+               lambda items: {decode(k): decode(v) for k, v in items}),
+}
+
+
+def encode(value):
+    if isinstance(value, list):
+        return [encode(v) for v in value]
+    if isinstance(value, dict) and all(isinstance(k, str) for k in value) and not (
+            len(value) == 1 and next(iter(value)) in TAGS):
+        return {k: encode(v) for k, v in value.items()}
+    # Checked in order, since a datetime is also a date.
+    for tag, (type, to_json, _) in TAGS.items():
+        if isinstance(value, type):
+            return {tag: to_json(value)}
+    return value
+
+
+def decode(value):
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    if isinstance(value, dict):
+        if len(value) == 1 and (tag := next(iter(value))) in TAGS:
+            return TAGS[tag][2](value[tag])
+        return {k: decode(v) for k, v in value.items()}
+    return value
+
+
+def dump_data(raw_data: dict) -> str:
+    return json.dumps(encode(raw_data))
+
+
+def load_data(data: str) -> dict:
+    return decode(json.loads(data))
+
+
+def add(data_dir: pathlib.Path, path: pathlib.Path):
+    """
+    Index a newly written record, so that it can be found by id before the next query.
+    """
+    stat = path.stat()
+    relative = os.path.relpath(path, data_dir)
+    try:
+        values = row(relative, stat.st_mtime_ns, stat.st_size, path.name, os.fspath(path), *read_record(path))
+    except Exception:
+        # Reported by the next refresh.
+        return
+    with contextlib.closing(connect(data_dir)) as conn, conn:
+        conn.execute(INSERT, values)
+
+
+def irrelevant_after(path: str, event: str, raw_data: dict) -> Optional[str]:
+    try:
+        value = extract_record(path, event, raw_data).irrelevant_after
+    except Exception:
+        # Reported when the record is queried.
+        return None
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    return value.isoformat() if value else None
+
+
+def records(data_dir: pathlib.Path, types: Optional[Iterable[str]]=None, relevant_only: bool=False) -> Iterator[Record]:
+    """
+    Refresh the index, then yield the parsed records of the given types (default all).
+
+    If relevant_only is set, completed records and records which stopped being relevant before
+    yesterday are skipped without being decoded. Callers must still check relevance
+    themselves; this only skips records which certainly aren't, and most records in a long
+    lived notes directory are old.
+    """
+    query = "SELECT path, event, raw_data FROM records WHERE 1"
+    params = []
+    if types is not None:
+        types = list(types)
+        query += f" AND type IN ({placeholders(types)})"
+        params += types
+    if relevant_only:
+        # The day of slack covers irrelevant_after datetimes in other timezones.
+        query += " AND NOT completed AND (irrelevant_after IS NULL OR irrelevant_after >= ?)"
+        params.append((datetime.datetime.now(TIMEZONE).date() - datetime.timedelta(days=1)).isoformat())
+    if not data_dir.is_dir():
+        # As with globbing a missing directory, there are no records.
+        return
+    try:
+        with contextlib.closing(connect(data_dir)) as conn:
+            refresh(conn, data_dir, types)
+            rows = conn.execute(query, params).fetchall()
+    except sqlite3.OperationalError:
+        # e.g. a read-only data directory. The index is only a cache, so read the files instead.
+        yield from parse_records([pathlib.Path(entry.path) for entry in iter_files(data_dir, suffixes(types))])
+        return
+    for relative, event, raw_data in rows:
+        path = data_dir / relative
+        try:
+            yield extract_record(path, event, load_data(raw_data))
+        except Exception as e:
+            print(f"Failed to parse {path}: {e}")
+
+
+def find(data_dir: pathlib.Path, id: str) -> Optional[pathlib.Path]:
+    """
+    Look up a record by file id or file name. Records not yet in the index are not found.
+
+    Like git hashes, file ids may be abbreviated to a unique prefix of at least 4 characters.
+    """
+    if not data_dir.is_dir():
+        return None
+    with contextlib.closing(connect(data_dir)) as conn:
+        rows = conn.execute("SELECT path FROM records WHERE file_id = ? OR name = ?", (id, id)).fetchall()
+        if not rows and 4 <= len(id) < 10:
+            # File ids are hex, so every id starting with the prefix sorts before prefix + "g".
+            rows = conn.execute(
+                "SELECT path FROM records WHERE file_id >= ? AND file_id < ? LIMIT 2", (id, id + "g")
+            ).fetchall()
+    if len(rows) == 1 and (path := data_dir / rows[0][0]).exists():
+        return path
@@ -1,22 +1,23 @@
 #!/usr/bin/env python
 import datetime as module_datetime
-import itertools
+import functools
+import heapq
+import mmap
 import operator
 import os
 import pathlib
+import re
+import sqlite3
 import sys
 import tempfile
-from subprocess import call
+from subprocess import call, run
 from typing import Optional
 
-import tabulate
-import blessings
 import typer
 
-from ruamel.yaml import YAML
-
-from .parser import TIMEZONE, parsed_records, parse_datetime_or_delta, file_id, dt_compare, \
-    parse_record
+from . import index
+from .parser import TIMEZONE, parse_datetime_or_delta, file_id, dt_compare, as_date, \
+    extract_record, load_yaml, dump_yaml, iter_files
 
 app = typer.Typer()
 
@@ -32,14 +33,19 @@ else:
     TEMPLATE_PATH = pathlib.Path(__file__).parent / "templates"
 
 
-TEMPLATES = list(itertools.chain(TEMPLATE_PATH.glob("*.md"), TEMPLATE_PATH.glob("*.txt"), TEMPLATE_PATH.glob("*.yaml")))
-
-COMMAND_TO_TEMPLATE = {f.stem.replace('-', '_'): f for f in TEMPLATES}
+@functools.cache
+def command_to_template() -> dict[str, pathlib.Path]:
+    templates = (pathlib.Path(entry.path) for entry in os.scandir(TEMPLATE_PATH)
+                 if entry.name.endswith((".md", ".txt", ".yaml")))
+    return {f.stem.replace('-', '_'): f for f in sorted(templates)}
 
 
 def show_table(table_data: list, headers: list, show_index=True, pickable=False, edit=False, cat=False, data_dir: pathlib.Path=DATA_PATH, bold=()):
-    t = blessings.Terminal()
-    table = tabulate.tabulate(table_data, headers=headers, showindex=show_index)
+    # Inline import to keep startup fast for commands that don't print tables.
+    import tabulate
+    table = tabulate.tabulate(table_data, headers=headers, showindex=show_index, disable_numparse=True)
+    if not pickable and not bold:
+        return print(table)
     rows = table.split('\n')
     if pickable:
         title = '\n'.join(['  ' + rows[0], '  ' + rows[1]])
@@ -54,6 +60,8 @@ def show_table(table_data: list, headers: list, show_index=True, pickable=False,
             print(file.read_text())
         return idx
     else:
+        import blessings
+        t = blessings.Terminal()
         formatted_rows = rows[:2]
         rows = rows[2:]
         for i, row in enumerate(rows):
@@ -63,6 +71,16 @@ def show_table(table_data: list, headers: list, show_index=True, pickable=False,
         return print('\n'.join(formatted_rows))
 
 
+def sort_table(table: list, key, limit: Optional[int]=None) -> list:
+    """
+    Sort the table rows, keeping only the first limit rows if given.
+    """
+    if limit is None:
+        return sorted(table, key=key)
+    # Cheaper than sorting everything when only a few rows are shown.
+    return heapq.nsmallest(limit, table, key=key)
+
+
 def edit_file(path: pathlib.Path):
     EDITOR = os.environ.get('EDITOR', 'vim')
     call([*EDITOR.split(), path])
@@ -80,25 +98,61 @@ def edit_template(text: str, suffix=None):
         return edited_message
 
 
+@functools.cache
+def jinja_environment():
+    from jinja2 import Environment, BaseLoader
+    return Environment(loader=BaseLoader())
+
+
+@functools.lru_cache(maxsize=64)
+def compile_template(path: pathlib.Path, mtime_ns: int):
+    return jinja_environment().from_string(path.read_text())
+
+
+PLACEHOLDER_RE = re.compile(r"{{ *(\w+) *}}")
+
+
+def render_template(template: pathlib.Path, **context: str) -> str:
+    text = template.read_text()
+    # Templates usually only have plain {{ variable }} placeholders, which don't need Jinja.
+    rendered = PLACEHOLDER_RE.sub(lambda m: context.get(m[1], m[0]), text)
+    if "{{" not in rendered and "{%" not in text and "{#" not in text:
+        return rendered
+    return compile_template(template, template.stat().st_mtime_ns).render(**context)
+
+
+TIMESTAMP_RE = re.compile(r"^timestamp:(.*)$", re.MULTILINE)
+
+
+def fill_timestamp(text: str, timestamp: str) -> str:
+    """
+    Set the timestamp of a rendered yaml record, for templates written before the {{ timestamp }}
+    placeholder which have "timestamp: null" (or no timestamp at all). Records need it to parse.
+    """
+    match = TIMESTAMP_RE.search(text)
+    if match is None:
+        if text and not text.endswith("\n"):
+            text += "\n"
+        return f"{text}timestamp: {timestamp}\n"
+    if match[1].split("#")[0].strip() in ("", "null", "~"):
+        return f"{text[:match.start()]}timestamp: {timestamp}{text[match.end():]}"
+    return text
+
+
 def do_note(template: pathlib.Path, data_dir: pathlib.Path=DATA_PATH):
     timestamp = module_datetime.datetime.now(TIMEZONE)
-    if template.suffix.lower() == ".yaml":
-        yaml_obj = YAML()
-        loaded = yaml_obj.load(template.read_text())
-        loaded["timestamp"] = timestamp
-        from io import StringIO
-        s = StringIO()
-        yaml_obj.dump(loaded, s)
-        value = s.getvalue()
-    else:
-        value = template.read_text()
-        from jinja2 import Environment, BaseLoader
-        rtemplate = Environment(loader=BaseLoader).from_string(value)
-        value = rtemplate.render(date=module_datetime.datetime.now(TIMEZONE).date().isoformat())
+    value = render_template(template, timestamp=timestamp.isoformat(), date=timestamp.date().isoformat())
+    if template.suffix == ".yaml":
+        value = fill_timestamp(value, timestamp.isoformat())
     final = edit_template(value, template.suffix)
     if final is not None:
         path = data_dir / f"{timestamp.year}/{timestamp.isoformat()}-{template.name}"
         path.write_text(final)
+        try:
+            index.add(data_dir, path)
+        except sqlite3.Error:
+            # The record is saved; it will be indexed (if possible) on the next query.
+            pass
 
         # TODO: validate show another editor window with the errors.
         print(f"{template.stem.title()} saved to {path} ({file_id(path)}).")
@@ -115,14 +169,21 @@ app.add_typer(record, name="add", help="Alias of record.")
 
 def do_template_command(command: str, data_dir: pathlib.Path=DATA_PATH):
     def _do_template(data_dir: pathlib.Path=data_dir):
-        return do_note(COMMAND_TO_TEMPLATE[command], data_dir=data_dir)
+        return do_note(command_to_template()[command], data_dir=data_dir)
     _do_template.__name__ = command
     return _do_template
 
-for command in COMMAND_TO_TEMPLATE:
-    method = do_template_command(command)
-    record.command()(method)
-    record.command(name=f"{command}s", help=f"Alias of {command}.", hidden=True)(method)
+def register_template_commands():
+    for command in command_to_template():
+        method = do_template_command(command)
+        record.command()(method)
+        record.command(name=f"{command}s", help=f"Alias of {command}.", hidden=True)(method)
+
+
+# Only scan the templates directory when a record command might be run (or shell completed),
+# rather than on every invocation.
+if {"record", "mark", "add"} & set(sys.argv[1:]) or any(var.endswith("_COMPLETE") for var in os.environ):
+    register_template_commands()
 
 
 query = typer.Typer()
@@ -132,7 +193,7 @@ app.add_typer(query, name="list", help="Alias of query.")
 
 @query.command()
 @query.command(name="task", help="Alias of tasks.", hidden=True)
-def tasks(data_dir: pathlib.Path=DATA_PATH, time_window: str="2 months", show_all: bool=False, edit: bool=False, created_on: Optional[str]=None, due_before: Optional[str]=None):
+def tasks(data_dir: pathlib.Path=DATA_PATH, time_window: str="2 months", show_all: bool=False, edit: bool=False, created_on: Optional[str]=None, due_before: Optional[str]=None, limit: Optional[int]=None):
     """
     Show all tasks from task and due dates.
 
@@ -140,6 +201,8 @@ def tasks(data_dir: pathlib.Path=DATA_PATH, time_window: str="2 months", show_al
 
     By default tasks due >2 months in the future will be excluded. To include them, use
     --time-window=never
+
+    --limit shows only the first N tasks.
     """
     now = module_datetime.datetime.now(tz=TIMEZONE)
     window = parse_datetime_or_delta(time_window, now)
@@ -151,35 +214,31 @@ def tasks(data_dir: pathlib.Path=DATA_PATH, time_window: str="2 months", show_al
         due_before = module_datetime.date(2100, 1, 1)
     table = []
     bold_row_ids = set()
-    today = module_datetime.datetime.now(TIMEZONE).date()
-    for parsed in parsed_records("**/*.yaml", data_dir=data_dir):
-        if parsed["type"] in ("task", "due-date", "focus") and (show_all or not parsed["completed_at"]):
-            due = parsed.get("due")
+    today = now.date()
+    for parsed in index.records(data_dir, types=("task", "due-date", "focus"), relevant_only=not show_all):
+        if show_all or not parsed.completed_at:
+            due = parsed.due
             if due and dt_compare(due_before, due):
                 continue
-            try:
-                due_date = due.date()
-            except AttributeError:
-                due_date = due
-            if due_date == today:
-                bold_row_ids.add(parsed["file_id"])
-            completed = parsed.get("completed")
-            if show_all or (not completed and parsed["still_relevant"]):
+            if as_date(due) == today:
+                bold_row_ids.add(parsed.file_id)
+            completed = parsed.completed
+            if show_all or (not completed and parsed.still_relevant):
+                created = parsed.created
                 if ((not due or dt_compare(due, window))
-                        and (not created_on or parsed["created"].date() == created_on)):
-                    event = parsed['event']
-                    if parsed["type"] == "focus":
-                        bold_row_ids.add(parsed["file_id"])
+                        and (not created_on or created.date() == created_on)):
+                    is_focus = parsed.type == "focus"
+                    if is_focus:
+                        bold_row_ids.add(parsed.file_id)
                     table.append((
-                        parsed["rank_priority"],
-                        parsed["type"].upper() if parsed["type"] == "focus" else "",
-                        (due.isoformat() if hasattr(due, "isoformat") else due) or "",
-                        event,
-                        parsed["created"].date().isoformat(),
+                        parsed.rank_priority,
+                        "FOCUS" if is_focus else "",
+                        (due.isoformat() if isinstance(due, module_datetime.date) else due) or "",
+                        parsed.event,
+                        created.date().isoformat(),
                         bool(completed),
-                        parsed["file_id"]))
-    table.sort(key=lambda x: (x[0], x[2]), reverse=False)
-    table = [t[1:] for t in table]
+                        parsed.file_id))
+    table = [t[1:] for t in sort_table(table, operator.itemgetter(0, 2), limit)]
     bold_rows = {i for i, row in enumerate(table) if row[-1] in bold_row_ids}
     show_table(
         table,
@@ -192,87 +251,106 @@ def tasks(data_dir: pathlib.Path=DATA_PATH, time_window: str="2 months", show_al
 
 
 @query.command()
-def predictions(data_dir: pathlib.Path=DATA_PATH, show_all: bool=False, edit: bool=False):
+def predictions(data_dir: pathlib.Path=DATA_PATH, show_all: bool=False, edit: bool=False, limit: Optional[int]=None):
     """
     Query predictions and due dates.
 
     If --show-all is selected, then completed predictions will be included.
     """
     table = []
-    for parsed in parsed_records("**/*.yaml", data_dir=data_dir):
-        if parsed["type"] == "prediction" and (show_all or not parsed["completed_at"]):
+    for parsed in index.records(data_dir, types=["prediction"]):
+        if show_all or not parsed.completed_at:
             table.append((
-                parsed["expected_completion"].isoformat(),
-                parsed["event"],
-                parsed["created"].date().isoformat(),
-                parsed["completed_at"],
-                parsed["file_id"],
+                parsed.expected_completion.isoformat(),
+                parsed.event,
+                parsed.created.date().isoformat(),
+                parsed.completed_at,
+                parsed.file_id,
             ))
 
-    table.sort(key=lambda x: x[0], reverse=False)
+    table = sort_table(table, operator.itemgetter(0), limit)
     show_table(table, headers=["Expected Completion", "Event", "Created", "Actual", "id"],
                edit=edit, data_dir=data_dir, pickable=edit)
 
 
-def list_md(data_dir: pathlib.Path=DATA_PATH, show_all: bool=False, edit: bool=False, suffix="note", tag=None, cat=False):
+def list_md(data_dir: pathlib.Path=DATA_PATH, show_all: bool=False, edit: bool=False, suffix="note", tag=None, cat=False, limit=None):
     table = []
-    for parsed in parsed_records(f"**/*-{suffix}.md", data_dir=data_dir):
-        if parsed["type"] == suffix:
-            completed = parsed["completed"]
-            irrelevant_after = parsed["irrelevant_after"]
-            title = parsed["event"]
-            date = parsed["created"]
-            if show_all or (not completed and dt_compare(module_datetime.datetime.now(), irrelevant_after)):
-                if tag is None or tag in parsed["tags"]:
+    now = module_datetime.datetime.now(tz=TIMEZONE)
+    for parsed in index.records(data_dir, types=[suffix], relevant_only=not show_all):
+        if parsed.path.suffix == ".md":
+            completed = parsed.completed
+            irrelevant_after = parsed.irrelevant_after
+            title = parsed.event
+            date = parsed.created
+            if show_all or (not completed and dt_compare(now, irrelevant_after)):
+                if tag is None or tag in parsed.tags:
                     table.append((
                         date.isoformat(),
                         title,
-                        ", ".join(parsed["tags"]),
-                        parsed["file_id"],
+                        ", ".join(parsed.tags),
+                        parsed.file_id,
                     ))
-    table.sort(key=lambda x: x[0], reverse=False)
+    table = sort_table(table, operator.itemgetter(0), limit)
     show_table(table, headers=["Date", "Title", "tags", "id"], pickable=edit or cat, edit=edit, cat=cat)
 
 
 @query.command(help="List all notes.")
 def notes(data_dir: pathlib.Path=DATA_PATH, show_all: bool=False, edit: bool=False,
-          tag: Optional[str]=None, cat: bool=False):
+          tag: Optional[str]=None, cat: bool=False, limit: Optional[int]=None):
     """
     List all notes.
 
     If --show-all is selected, then completed notes will be included.
     """
-    return list_md(data_dir=data_dir, show_all=show_all, edit=edit, suffix="note", tag=tag, cat=cat)
+    return list_md(data_dir=data_dir, show_all=show_all, edit=edit, suffix="note", tag=tag, cat=cat, limit=limit)
 
 
 @query.command(help="List all gists.")
 def gists(data_dir: pathlib.Path=DATA_PATH, show_all: bool=False, edit: bool=False,
-          tag: Optional[str]=None, cat: bool=False):
+          tag: Optional[str]=None, cat: bool=False, limit: Optional[int]=None):
     """
     List all notes.
 
     If --show-all is selected, then completed notes will be included.
     """
-    return list_md(data_dir=data_dir, show_all=show_all, edit=edit, suffix="gist", tag=tag, cat=cat)
+    return list_md(data_dir=data_dir, show_all=show_all, edit=edit, suffix="gist", tag=tag, cat=cat, limit=limit)
 
 
 
 def by_id(data_dir: pathlib.Path=DATA_PATH, id: str=None) -> pathlib.Path:
     """
-    Query by id.
+    Query by id. The id may also be a file name, or a path relative to the data directory.
     """
-    for file in data_dir.glob("**/*.*"):
-        if id == file.name or id == file_id(file):
-            return file
-
-def cmd_by_id(default: str, data_dir: pathlib.Path=DATA_PATH, id: str=None, env_variable: Optional[str]=None):
-    cmd = os.environ.get(env_variable, default)
+    if "/" in id and (file := data_dir / id).exists():
+        return file
+    # Records are saved to a directory named after the year their file name starts with.
+    if id.endswith((".yaml", ".md")) and (file := data_dir / id[:4] / id).exists():
+        return file
+    try:
+        file = index.find(data_dir, id)
+    except sqlite3.Error as e:
+        # The index is only a shortcut, so fall back to walking the data directory.
+        print(f"Failed to read the index: {e}", file=sys.stderr)
+        file = None
+    if file is not None:
+        return file
+    for entry in iter_files(data_dir):
+        if id == entry.name or id == file_id(entry.name):
+            return pathlib.Path(entry.path)
+
+
+def by_id_or_exit(data_dir: pathlib.Path=DATA_PATH, id: str=None) -> pathlib.Path:
     file = by_id(data_dir, id)
-    if id is None:
+    if file is None:
         print(f"No file found with id {id}")
         sys.exit(1)
-    else:
-        call([*cmd.split(), str(file)])
+    return file
+
+
+def cmd_by_id(default: str, data_dir: pathlib.Path=DATA_PATH, id: str=None, env_variable: Optional[str]=None):
+    cmd = os.environ.get(env_variable, default)
+    file = by_id_or_exit(data_dir, id)
+    call([*cmd.split(), str(file)])
 
 @app.command(help="Edit a record by id.", name="edit")
 @query.command(help="Edit a record by id.", name="edit")
@@ -310,27 +388,25 @@ def complete(id: str, *,  completed_at=None, data_dir: pathlib.Path=DATA_PATH):
     else:
         completed_at = parse_datetime_or_delta(completed_at, module_datetime.datetime.now(tz=TIMEZONE))
     def do_complete(file: pathlib.Path):
-        yaml = YAML(typ="safe")
-        value = yaml.load(file)
+        value = load_yaml(file.read_text())
         value["completed_at"] = completed_at
         value["completed"] = True
-        yaml.dump(value, file)
+        file.write_text(dump_yaml(value))
         print(f"Marked {file_id(file)} as complete ({value['event']}).")
 
     if id != "pick":
-        for task in data_dir.glob("**/*.*"):
-            if id == task.name or id == file_id(task):
-                do_complete(task)
-                return
+        do_complete(by_id_or_exit(data_dir, id))
     else:
+        records = [
+            parsed for parsed in index.records(data_dir)
+            if parsed.path.suffix == ".yaml" and not parsed.completed
+        ]
         table = [
-            (parsed["created"].date(), parsed["type"], parsed["due"], parsed["event"], parsed["file_id"])
-            for parsed in parsed_records("**/*.yaml", data_dir=data_dir)
-            if "completed" in parsed and not parsed["completed"]
+            (parsed.created.date(), parsed.type, parsed.due, parsed.event, parsed.file_id)
+            for parsed in records
         ]
         row_num = show_table(table, headers=["created", "type", "due", "event", "id"], edit=False, pickable=True)
-        row = table[row_num]
-        do_complete(by_id(id=row[-1], data_dir=data_dir))
+        do_complete(records[row_num].path)
 
 
 @record.command(help="Push off a due date by the specified amount.")
@@ -341,42 +417,72 @@ def push(id: str, data_dir: pathlib.Path=DATA_PATH):
     new_due_date = parse_datetime_or_delta(push_to, today)
 
     def do_push(file: pathlib.Path):
-        parsed = parse_record(file)
-        yaml = YAML(typ="safe")
-        value = yaml.load(file)
+        value = load_yaml(file.read_text())
+        parsed = extract_record(file, value["event"], value)
         value.setdefault("previous_due_dates", [])
         value["previous_due_dates"].append(value['due'])
         value["due"] = new_due_date.isoformat()
-        yaml.dump(value, file)
-        print(f"Pushed {file_id(file)} to {new_due_date.isoformat()}; previously {parsed['due'].isoformat()}.")
+        file.write_text(dump_yaml(value))
+        print(f"Pushed {file_id(file)} to {new_due_date.isoformat()}; previously {parsed.due.isoformat()}.")
 
     if id != "pick":
-        for task in data_dir.glob("**/*.*"):
-            if id == task.name or id == file_id(task):
-                do_push(task)
-                return
+        do_push(by_id_or_exit(data_dir, id))
     else:
+        records = sorted(
+            (parsed for parsed in index.records(data_dir)
+             if parsed.path.suffix == ".yaml" and not parsed.completed and parsed.due is not None),
+            key=operator.attrgetter("due"),
+        )
         table = [
-            (parsed["created"].date(), parsed["type"], parsed["due"], parsed["event"], parsed["file_id"])
-            for parsed in parsed_records("**/*.yaml", data_dir=data_dir)
-            if "completed" in parsed and not parsed["completed"] and parsed.get("due") is not None
+            (parsed.created.date(), parsed.type, parsed.due, parsed.event, parsed.file_id)
+            for parsed in records
         ]
-        table.sort(key=operator.itemgetter(2))
         row_num = show_table(table, headers=["created", "type", "due", "event", "id"], edit=False, pickable=True)
-        row = table[row_num]
-        do_push(by_id(id=row[-1], data_dir=data_dir))
+        do_push(records[row_num].path)
 
 
-@query.command(help="Search records for a given string.")
-def grep(string: str, data_dir: pathlib.Path=DATA_PATH, edit=False):
+def grep_files(string: str, data_dir: pathlib.Path=DATA_PATH) -> list[pathlib.Path]:
     """
-    TODO: should we just defer this entirely to grep, like git-grep, then display the match
-          in our tabular format.
+    Find files containing the given string, deferring to grep (or ripgrep) when available since
+    they are much faster than reading every file into python.
     """
-    data = []
-    for task in data_dir.glob("**/*.*"):
-        if string in task.read_text():
-            data.append((task.name, file_id(task)))
+    # "--" so that strings starting with a dash aren't read as options.
+    commands = [
+        ["grep", "-rlF", "--include=*.*", "--", string, str(data_dir)],
+        ["rg", "-lF", "--glob=*.*", "--", string, str(data_dir)],
+    ]
+    for command in commands:
+        try:
+            result = run(command, capture_output=True, text=True)
+        except FileNotFoundError:
+            continue
+        # Exit status 1 means there were no matches; anything higher is an error.
+        if result.returncode <= 1:
+            paths = [pathlib.Path(line) for line in result.stdout.splitlines()]
+            # Skip hidden files here, since grep's --exclude-dir would also match a data_dir like ~/.notes.
+            return [
+                path for path in paths
+                if not any(part.startswith(".") for part in path.relative_to(data_dir).parts)
+            ]
+    # Search the raw bytes of memory mapped files, rather than decoding every file to a str.
+    needle = string.encode()
+    files = []
+    for entry in iter_files(data_dir):
+        with open(entry.path, "rb") as f:
+            try:
+                contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped (and can't match).
+                continue
+            with contents:
+                if contents.find(needle) != -1:
+                    files.append(pathlib.Path(entry.path))
+    return files
+
+
+@query.command(help="Search records for a given string.")
+def grep(string: str, data_dir: pathlib.Path=DATA_PATH, edit: bool=False):
+    data = sorted((file.name, file_id(file)) for file in grep_files(string, data_dir=data_dir))
     show_table(data, headers=["Name", "id"], edit=edit, pickable=edit)
 
 
@@ -1,36 +1,86 @@
+import calendar
 import datetime
+import functools
 import hashlib
 import pathlib
 import zoneinfo
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, NamedTuple
 
-import commonmark
-from dateutil.relativedelta import relativedelta
-import regex as re
-from ruamel.yaml import YAML
+import yaml
 
-yaml = YAML(typ="safe")
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    # PyYAML was built without libyaml; the pure python versions are much slower.
+    from yaml import SafeLoader, SafeDumper
 
-markdown_parser = commonmark.Parser()
+
+class Loader(SafeLoader):
+    pass
+
+
+# YAML 1.1 reads times of day like 12:30 as base 60 integers (750), so keep them as strings.
+Loader.yaml_implicit_resolvers = {
+    char: [("tag:yaml.org,2002:str", re.compile(r"^\d{1,2}:\d{2}$")), *resolvers] if char.isdigit() else resolvers
+    for char, resolvers in SafeLoader.yaml_implicit_resolvers.items()
+}
+
+
+class Dumper(SafeDumper):
+    pass
+
+
+def represent_str(dumper, data):
+    # Write multiline strings (e.g. notes) as literal blocks, like the templates do.
+    style = "|" if "\n" in data else None
+    return dumper.represent_scalar("tag:yaml.org,2002:str", data, style=style)
+
+
+Dumper.add_representer(str, represent_str)
+
+
+def load_yaml(stream):
+    return yaml.load(stream, Loader=Loader)
+
+
+def dump_yaml(data, stream=None):
+    return yaml.dump(data, stream, Dumper=Dumper, default_flow_style=False, sort_keys=False, allow_unicode=True)
 
 
 TIMEZONE = zoneinfo.ZoneInfo(os.environ.get("NOTES_TIMEZONE", "America/Los_Angeles"))
 
 
+@functools.cache
 def parse_bday(bday: str):
     # Inline import because pandas is pretty slow to import.
     from pandas.tseries.offsets import BDay
     return BDay(int(bday))
 
 
+class Months:
+    """
+    A number of calendar months, which can be added to a date or datetime. As with dateutil's
+    relativedelta, the day is clamped to the length of the resulting month.
+    """
+    def __init__(self, months: int):
+        self.months = months
+
+    def __radd__(self, other: datetime.date) -> datetime.date:
+        years, month = divmod(other.month - 1 + self.months, 12)
+        year = other.year + years
+        day = min(other.day, calendar.monthrange(year, month + 1)[1])
+        return other.replace(year=year, month=month + 1, day=day)
+
+
 TIME_UNITS = {
     "hour": (lambda x: datetime.timedelta(hours=int(x))),
     "day": (lambda x: datetime.timedelta(days=int(x))),
     "week": (lambda x: datetime.timedelta(weeks=int(x))),
-    "year": (lambda x: relativedelta(years=int(x))),
-
-    "month": (lambda x: relativedelta(months=int(x))),
+    "year": (lambda x: Months(12 * int(x))),
+    "month": (lambda x: Months(int(x))),
     "business day": parse_bday,
 }
 
@@ -47,152 +97,311 @@ DAYS_OF_WEEK = {
 }
 
 
+# Functions of the reference date for each named day.
 SPECIAL_DAYS = {
-    "today", "tomorrow", "yesterday",
-    *DAYS_OF_WEEK.keys(),
-    *["next %s" % day for day in DAYS_OF_WEEK.keys()],
+    "today": lambda today: today,
+    "tomorrow": lambda today: today + datetime.timedelta(days=1),
+    "yesterday": lambda today: today - datetime.timedelta(days=1),
+    # "Monday" on Wednesday refers to two days previously.
+    # "Friday" on a Wednesday refers to two days later.
+    **{day: (lambda today, n=n: today + datetime.timedelta(days=n - today.weekday()))
+       for day, n in DAYS_OF_WEEK.items()},
+    # "Next Friday" on a Wednesday refers to the following Friday (9 days later).
+    **{f"next {day}": (lambda today, n=n: today + datetime.timedelta(days=7 - today.weekday() + n))
+       for day, n in DAYS_OF_WEEK.items()},
 }
 
 
+@functools.lru_cache(maxsize=256)
+def time_delta(unit: str, amount: str):
+    # Records use a small vocabulary of deltas ("1 month", "2 weeks", ...), so reuse them.
+    return TIME_UNITS[unit](amount)
+
+
+# Longest first. None of the current units is a prefix of another, but if one is added later
+# (e.g. "day" and "day off"), the longer one is tried first rather than after a failed match.
+UNITS_PATTERN = "|".join(map(re.escape, sorted(TIME_UNITS, key=len, reverse=True)))
+
+# All the numeric formats, so that a single match finds which one (if any) applies.
+DATETIME_RE = re.compile(
+    rf"(?P<delta>(?P<amount>\d+) (?P<unit>{UNITS_PATTERN})s?)"
+    r"|(?P<time_of_day>\d{2}:\d{2})"
+    r"|(?P<date>\d{4}-\d{2}-\d{2})"
+    r"|(?P<date_hour>\d{4}-\d{2}-\d{2} \d{2} (?:am|pm))"
+)
+
+
 def parse_datetime_or_delta(
     s: str | datetime.datetime | datetime.date | None,
     ts: datetime.datetime | datetime.date,
 ) -> datetime.datetime | datetime.date:
     if not isinstance(s, str) or not s:
         return s
-    if s.lower() == "never":
+    # Aware datetimes in different timezones can be equal, so the timezone is part of the key.
+    return parse_datetime_str(s, ts, getattr(ts, "tzinfo", None))
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_datetime_str(s: str, ts: datetime.datetime | datetime.date, tzinfo) -> datetime.datetime | datetime.date:
+    """
+    Cached implementation of parse_datetime_or_delta. Refreshing the index and then querying it
+    extracts each new record twice, with the same arguments.
+    """
+    # Every numeric format starts with a digit, and named days never do.
+    m = DATETIME_RE.fullmatch(s) if s[0].isdigit() else None
+    kind = m.lastgroup if m else None
+    if kind == "delta":
+        unit = m["unit"]
+        result = ts + time_delta(unit, m["amount"])
+        return result if unit == "hour" else as_date(result)
+    lowered = s.lower()
+    if lowered == "never":
         return datetime.date(2100, 1, 1)
-    elif re.fullmatch(r"\d{2}:\d{2}", s):
-        time = datetime.datetime.strptime(s, "%H:%M", tzinfo=TIMEZONE).time()
-        return ts.replace(hour=time.hour, minute=time.minute, second=0, microsecond=0)
-    elif re.fullmatch(r"\d{4}-\d{2}-\d{2}", s):
-        return datetime.datetime.strptime(s, "%Y-%m-%d").date()
-    elif re.fullmatch(r"\d{4}-\d{2}-\d{2} \d{2} (am|pm)", s):
-        return datetime.datetime.strptime(s, '%Y-%m-%d %H:%M %p', tzinfo=TIMEZONE)
-    elif (m := re.fullmatch(r"(\d+) (\L<formats>)s?", s, formats=list(TIME_UNITS))):
-        unit = m.group(2)
-        result = ts + TIME_UNITS[unit](m.group(1))
-        if unit != "hour" and hasattr(result, "date"):
-            result = result.date()
-        return result
-    elif s.lower() in SPECIAL_DAYS:
-        today = ts.date() if hasattr(ts, "date") else ts
-        match s.lower().split():
-            case ["today"]:
-                return today
-            case ["tomorrow"]:
-                return today + datetime.timedelta(days=1)
-            case ["yesterday"]:
-                return today - datetime.timedelta(days=-1)
-            case ["next", day]:
-                next_monday = today + datetime.timedelta(days=7 - today.weekday())
-                return next_monday + datetime.timedelta(days=DAYS_OF_WEEK[day])
-            case [day]:
-                desired_day = DAYS_OF_WEEK[day]
-                # "Monday" on Wednesday refers to two days previously.
-                # "Friday" on a Wednesday refers to two days later.
-                # "Next Friday" on a Wednesday refers to the following Friday (9 days later).
-                return today + datetime.timedelta(days=desired_day - today.weekday())
-        assert False, "unreachable"
-    elif s.lower() == "tomorrow":
-        return (ts.date() if hasattr(ts, "date") else ts) + datetime.timedelta(days=1)
+    # The formats below are fixed width, so slice out the numbers rather than using strptime.
+    elif kind == "time_of_day":
+        return ts.replace(hour=int(s[0:2]), minute=int(s[3:5]), second=0, microsecond=0)
+    elif kind == "date":
+        return datetime.date(int(s[0:4]), int(s[5:7]), int(s[8:10]))
+    elif kind == "date_hour":
+        hour = int(s[11:13])
+        if not 1 <= hour <= 12:
+            raise ValueError(f"Hour out of range: {s}.")
+        hour = hour % 12 + (12 if s.endswith("pm") else 0)
+        return datetime.datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), hour, tzinfo=TIMEZONE)
+    elif (special_day := SPECIAL_DAYS.get(lowered)):
+        return special_day(as_date(ts))
     else:
         raise ValueError(f"Unrecognized format: {s}.")
 
+
 def is_date(d):
     return isinstance(d, datetime.date) and not isinstance(d, datetime.datetime)
 
 
+def as_date(d):
+    return d.date() if isinstance(d, datetime.datetime) else d
+
+
 def dt_compare(d1, d2):
-    if is_date(d1) and not is_date(d2):
-        d2 = d2.date()
-    elif is_date(d2) and not is_date(d1):
-        d1 = d1.date()
+    # Usually both are dates or both are datetimes, which compare directly.
+    if type(d1) is type(d2):
+        return d1 <= d2
+    # Otherwise a date is compared with the date part of a datetime.
+    if is_date(d1) or is_date(d2):
+        return as_date(d1) <= as_date(d2)
     return d1 <= d2
 
 
-def parse_record(path: pathlib.Path) -> dict:
-    ext = path.suffix
-    extracts = {}
-    orig = path.read_text()
+class Record(NamedTuple):
+    event: str
+    created: datetime.datetime | datetime.date | None
+    expected_completion: datetime.datetime | datetime.date | None
+    due: datetime.datetime | datetime.date | None
+    irrelevant_after: datetime.datetime | datetime.date | None
+    irrelevant_before: datetime.datetime | datetime.date | None
+    still_relevant: bool
+    completed: bool | None
+    completed_at: datetime.datetime | datetime.date | None
+    tags: list[str]
+    raw_data: dict
+    type: str
+    file_id: str
+    path: pathlib.Path
+    rank_priority: int
+
+
+def parse_record(path: str | os.PathLike) -> Record:
+    return extract_record(pathlib.Path(path), *read_record(path))
+
+
+def read_record(path: str | os.PathLike) -> tuple[str, dict]:
+    """
+    Read the event (title) and yaml data of a record. This is the expensive part of parsing.
+    """
+    ext = os.path.splitext(path)[1]
     if ext == ".md":
-        parsed = markdown_parser.parse(orig)
-        nodes = list(parsed.walker())
-        heading = next(n[0] for n in nodes if n[0].t == "heading" and n[0].level == 1)
-        extracts["event"] = heading.first_child.literal
-        metadata = next(n[0] for n in reversed(nodes) if n[0].t == "code_block" and n[0].info == "yaml")
-        raw_data = yaml.load(metadata.literal)
+        with open(path, "rb") as f:
+            event, metadata = read_markdown(f.read())
+        raw_data = load_yaml(metadata)
     elif ext == ".yaml":
-        raw_data = yaml.load(path.read_text())
-        extracts["event"] = raw_data["event"]
+        # libyaml decodes the bytes itself, so don't decode them in python first.
+        with open(path, "rb") as f:
+            raw_data = load_yaml(f)
+        event = raw_data["event"]
     else:
         raise ValueError(f"Unknown file type: {ext}")
+    return event, raw_data
+
+
+HEADING_RE = re.compile(rb"^# +(.+?) *\r?$", re.MULTILINE)
+METADATA_RE = re.compile(rb"^```yaml\r?\n(.*?)^```", re.MULTILINE | re.DOTALL)
+
+
+def read_markdown(data: bytes) -> tuple[str, bytes | str]:
+    """
+    Extract the title (first level 1 heading) and yaml metadata (last yaml code block) of a note.
+
+    Notes almost always look like the templates, so a regex finds both without building the
+    whole markdown AST, or even decoding the rest of the file. Anything unusual falls back to
+    commonmark.
+    """
+    heading = HEADING_RE.search(data)
+    metadata = METADATA_RE.findall(data)
+    if heading and metadata and b"```" not in data[:heading.start()]:
+        return heading.group(1).decode(), metadata[-1]
+    # Inline import, since commonmark is only needed for notes the regexes can't handle.
+    import commonmark
+    # Parsers keep their state on the instance, and records are read from several threads at
+    # once, so each note gets its own.
+    heading = metadata = None
+    for node, entering in commonmark.Parser().parse(data.decode()).walker():
+        if not entering:
+            continue
+        if node.t == "heading" and node.level == 1 and heading is None:
+            heading = node
+        elif node.t == "code_block" and node.info == "yaml":
+            metadata = node
+    if heading is None:
+        raise ValueError("No level 1 heading")
+    if metadata is None:
+        raise ValueError("No yaml metadata")
+    return heading.first_child.literal, metadata.literal
+
+
+def read_records(paths: list[str | os.PathLike]) -> Iterator[tuple[str, dict] | None]:
+    """
+    Read each of the given records, yielding None (and printing the error) for any that fail.
+
+    Reading is i/o bound, so large batches are spread over a thread pool.
+    """
+    def do_read(path):
+        try:
+            return read_record(path)
+        except Exception as e:
+            print(f"Failed to parse {path}: {e}")
+    if len(paths) <= 16:
+        # Not worth the overhead of starting threads.
+        yield from map(do_read, paths)
+    else:
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as ex:
+            yield from ex.map(do_read, paths)
 
-    extracts["created"] = created =  raw_data.get("date") or raw_data.get("timestamp")
-    if isinstance(created, datetime.datetime):
-        # The yaml parser takes a timestamp like 2022-05-19 22:01:55.699594-07:00, and turns
-        # it into a naive timestamp at UTC, like 2022-05-20T05:01:55.699594. So stupid, smdh.
-        extracts["created"] = (
-            datetime.datetime(*created.timetuple()[:6], tzinfo=datetime.timezone.utc)
-            .astimezone(TIMEZONE)
-        )
-
-    extracts["expected_completion"] = parse_datetime_or_delta(
-        raw_data.get("expected_completion"), extracts["created"])
-    extracts["due"] = parse_datetime_or_delta(raw_data.get("due"), extracts["created"])
-    relative_to_date = (
-        extracts["expected_completion"] or extracts["due"] or extracts["created"] or datetime.date.today())
-
-    for key in ["irrelevant_after", "irrelevant_before"]:
-        irrelevant = None
-        if (irrelevant := raw_data.get(key)):
-            if irrelevant == '==due':
-                irrelevant = extracts["due"]
-            else:
-                irrelevant = parse_datetime_or_delta(irrelevant, relative_to_date)
-        elif key == "irrelevant_after":
-            irrelevant = extracts["created"] + datetime.timedelta(days=365)
-        extracts[key] = irrelevant
-
-    now = datetime.datetime.now(tz=TIMEZONE)
-    extracts["still_relevant"] = True
-    if extracts["irrelevant_after"]:
-        extracts["still_relevant"] = dt_compare(now, extracts["irrelevant_after"]) and extracts["still_relevant"]
-    if extracts["irrelevant_before"]:
-        extracts["still_relevant"] = dt_compare(extracts["irrelevant_before"], now) and extracts["still_relevant"]
 
-    extracts["completed"] = raw_data.get("completed")
-    extracts["completed_at"] = parse_datetime_or_delta(raw_data.get("completed_at"), relative_to_date)
-    extracts["tags"] = raw_data.get("tags", [])
-    extracts["file"] = path
-    extracts["raw_data"] = raw_data
-    [type] = re.findall(r'[0-9T:.-]+-(.*)', path.stem)
-    extracts["type"] = type
-    extracts["file_id"] = file_id(path)
-    extracts["path"] = path
-    extracts["rank_priority"] = raw_data.get('rank_priority')
-    if extracts["rank_priority"] is None:
-        extracts["rank_priority"] = 10_000
+RECORD_TYPE_RE = re.compile(r'[0-9T:.-]+-(.*)')
 
 
-    return extracts
+def record_type(path: str | os.PathLike) -> str:
+    name = os.path.basename(path)
+    types = RECORD_TYPE_RE.findall(os.path.splitext(name)[0])
+    if len(types) != 1:
+        raise ValueError(f"Expected a file name like <timestamp>-<type>, not {name}")
+    return types[0]
 
 
-def file_id(path):
-    if isinstance(path, str):
-        path = pathlib.Path(path)
-    return hashlib.blake2s(path.name.encode()).hexdigest()[:10]
+def extract_record(path: pathlib.Path, event: str, raw_data: dict) -> Record:
+    created = raw_data.get("date") or raw_data.get("timestamp")
+    if isinstance(created, datetime.datetime):
+        # Timestamps without an offset are UTC according to the YAML spec.
+        if created.tzinfo is None:
+            created = created.replace(tzinfo=datetime.timezone.utc)
+        created = created.astimezone(TIMEZONE)
 
+    expected_completion = parse_datetime_or_delta(raw_data.get("expected_completion"), created)
+    due = parse_datetime_or_delta(raw_data.get("due"), created)
+    relative_to_date = expected_completion or due or created or datetime.date.today()
 
+    irrelevant = {}
+    for key in ["irrelevant_after", "irrelevant_before"]:
+        if (value := raw_data.get(key)):
+            if value == '==due':
+                value = due
+            else:
+                value = parse_datetime_or_delta(value, relative_to_date)
+        elif key == "irrelevant_after":
+            value = created + datetime.timedelta(days=365)
+        irrelevant[key] = value
+    irrelevant_after, irrelevant_before = irrelevant["irrelevant_after"], irrelevant["irrelevant_before"]
 
-def parsed_records(glob: str, data_dir: pathlib.Path) -> list[dict]:
-    def do_parse(path):
+    now = datetime.datetime.now(tz=TIMEZONE)
+    still_relevant = True
+    if irrelevant_after:
+        still_relevant = dt_compare(now, irrelevant_after) and still_relevant
+    if irrelevant_before:
+        still_relevant = dt_compare(irrelevant_before, now) and still_relevant
+
+    rank_priority = raw_data.get('rank_priority')
+    if rank_priority is None:
+        rank_priority = 10_000
+
+    return Record(
+        event=event,
+        created=created,
+        expected_completion=expected_completion,
+        due=due,
+        irrelevant_after=irrelevant_after,
+        irrelevant_before=irrelevant_before,
+        still_relevant=still_relevant,
+        completed=raw_data.get("completed"),
+        completed_at=parse_datetime_or_delta(raw_data.get("completed_at"), relative_to_date),
+        tags=raw_data.get("tags", []),
+        raw_data=raw_data,
+        type=record_type(path),
+        file_id=file_id(path),
+        path=path,
+        rank_priority=rank_priority,
+    )
+
+
+def file_id(path: str | os.PathLike) -> str:
+    return file_id_from_name(os.path.basename(path))
+
+
+@functools.cache
+def file_id_from_name(name: str) -> str:
+    return hashlib.blake2s(name.encode()).hexdigest()[:10]
+
+
+
+def iter_files(root: str | os.PathLike, suffix: str | tuple[str, ...] = "") -> Iterator[os.DirEntry]:
+    """
+    Recursively yield the files under root whose names end with suffix, skipping dotfiles.
+
+    This is much faster than Path.glob("**/*"), which builds a Path for every entry it visits.
+    """
+    stack = [os.fspath(root)]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            # e.g. a directory removed or made unreadable mid-walk, which Path.glob also ignores.
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(suffix) and entry.is_file():
+                    yield entry
+
+
+def parsed_records(glob: str, data_dir: pathlib.Path) -> Iterator[Record]:
+    """
+    Parse the records under data_dir matching glob, printing any which fail.
+
+    The commands query the index instead; this always reads the files.
+    """
+    return parse_records(list(data_dir.glob(glob)))
+
+
+def parse_records(paths: list[pathlib.Path]) -> Iterator[Record]:
+    """
+    Parse the given records, printing any which fail.
+    """
+    for path, record in zip(paths, read_records(paths)):
+        if record is None:
+            continue
         try:
-            return parse_record(path)
+            yield extract_record(path, *record)
         except Exception as e:
-            import pdb; pdb.post_mortem()
             print(f"Failed to parse {path}: {e}")
-    with ThreadPoolExecutor(max_workers=1) as ex:
-        futures = [ex.submit(do_parse, path) for path in data_dir.glob(glob)]
-        for fut in as_completed(futures):
-            yield fut.result()
@@ -0,0 +1,141 @@
+import os
+import pathlib
+import shutil
+import sqlite3
+
+import pytest
+
+from notes import index
+from notes.parser import load_yaml
+
+DATA_DIR = pathlib.Path(__file__).parent / "data" / "date-parsing" / "data"
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    shutil.copytree(DATA_DIR, tmp_path / "data")
+    return tmp_path / "data"
+
+
+def test_records(data_dir):
+    events = sorted(parsed.event for parsed in index.records(data_dir, types=["task"]))
+    assert events == ["Task 2", "Task1"]
+    assert list(index.records(data_dir, types=["prediction"])) == []
+
+
+def test_records_reparses_modified_files(data_dir):
+    list(index.records(data_dir, types=["task"]))
+    path = data_dir / "2022" / "2022-05-03T00:22:58.845189-07:00-task.yaml"
+    path.write_text(path.read_text().replace("event: Task1", "event: Renamed"))
+    os.utime(path, ns=(0, 0))
+    (data_dir / "2022" / "2022-05-03T00:25:56.215626-07:00-task.yaml").unlink()
+    assert [parsed.event for parsed in index.records(data_dir, types=["task"])] == ["Renamed"]
+
+
+def test_find(data_dir):
+    list(index.records(data_dir, types=["task"]))
+    path = data_dir / "2022" / "2022-05-03T00:22:58.845189-07:00-task.yaml"
+    assert index.find(data_dir, "366f31655b") == path
+    assert index.find(data_dir, path.name) == path
+    assert index.find(data_dir, "0000000000") is None
+    assert index.find(data_dir, "366f3") == path
+    # Too short.
+    assert index.find(data_dir, "366") is None
+
+
+def test_records_only_parses_requested_types(data_dir, capsys):
+    (data_dir / "2022" / "2022-05-04T00:00:00-07:00-prediction.yaml").write_text("not: [valid")
+    assert len(list(index.records(data_dir, types=["task"]))) == 2
+    assert capsys.readouterr().out == ""
+    assert list(index.records(data_dir, types=["prediction"])) == []
+    assert "Failed to parse" in capsys.readouterr().out
+
+
+def test_records_many_files(data_dir):
+    template = (data_dir / "2022" / "2022-05-03T00:22:58.845189-07:00-task.yaml").read_text()
+    for i in range(40):
+        (data_dir / "2022" / f"2022-06-{i:02}T00:00:00-07:00-task.yaml").write_text(template)
+    assert len(list(index.records(data_dir, types=["task"]))) == 42
+
+
+def test_records_relevant_only(data_dir):
+    # The test tasks became irrelevant a month after they were due in 2022.
+    assert len(list(index.records(data_dir, types=["task"], relevant_only=True))) == 0
+    path = data_dir / "2022" / "2022-05-03T00:22:58.845189-07:00-task.yaml"
+    path.write_text(path.read_text().replace("irrelevant_after: 1 month", "irrelevant_after: never"))
+    os.utime(path, ns=(0, 0))
+    assert [parsed.event for parsed in index.records(data_dir, types=["task"], relevant_only=True)] == ["Task1"]
+
+
+def test_records_all_types(data_dir):
+    (data_dir / "2022" / "2022-05-04T00:00:00-07:00-event.yaml").write_text(
+        "event: Something\ntimestamp: 2022-05-04 00:00:00-07:00\n")
+    assert sorted(parsed.type for parsed in index.records(data_dir)) == ["event", "task", "task"]
+
+
+def test_records_reparses_resized_files_with_same_mtime(data_dir):
+    list(index.records(data_dir, types=["task"]))
+    path = data_dir / "2022" / "2022-05-03T00:22:58.845189-07:00-task.yaml"
+    mtime_ns = path.stat().st_mtime_ns
+    path.write_text(path.read_text().replace("event: Task1", "event: Renamed"))
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+    assert "Renamed" in [parsed.event for parsed in index.records(data_dir, types=["task"])]
+
+
+def test_add(data_dir):
+    path = data_dir / "2022" / "2022-05-04T00:00:00-07:00-event.yaml"
+    path.write_text("event: Something\ntimestamp: 2022-05-04 00:00:00-07:00\n")
+    index.add(data_dir, path)
+    assert index.find(data_dir, path.name) == path
+
+
+def test_records_rebuilds_corrupt_index(data_dir):
+    (data_dir / index.INDEX_NAME).write_bytes(b"not a database" * 100)
+    assert len(list(index.records(data_dir, types=["task"]))) == 2
+    assert index.find(data_dir, "366f31655b") is not None
+
+
+def test_records_missing_data_dir(tmp_path):
+    assert list(index.records(tmp_path / "missing")) == []
+    assert index.find(tmp_path / "missing", "366f31655b") is None
+
+
+def test_records_skips_badly_named_files(data_dir, capsys):
+    (data_dir / "misc.yaml").write_text("event: x\n")
+    (data_dir / "2022" / "foo-task.yaml").write_text("event: x\n")
+    assert len(list(index.records(data_dir))) == 2
+    assert len(list(index.records(data_dir, types=["task"]))) == 2
+    out = capsys.readouterr().out
+    assert "Failed to parse" in out and "misc.yaml" in out and "foo-task.yaml" in out
+
+
+def test_dump_data_round_trip():
+    raw_data = load_yaml(
+        "date: 2022-05-03\n"
+        "timestamp: 2022-05-03 00:22:58.845189-07:00\n"
+        "due: '12:30'\n"
+        "keys: {1: x, 2022-01-01: y}\n"
+        "tag: {$date: not a date}\n"
+        "data: !!binary aGVsbG8=\n"
+        "set: !!set {x}\n"
+        "pairs: !!pairs [a: 1]\n"
+        "tags: [a, 1, 2.5, null, true]\n"
+    )
+    assert index.load_data(index.dump_data(raw_data)) == raw_data
+
+
+def test_connect_keeps_locked_index(data_dir, monkeypatch):
+    list(index.records(data_dir, types=["task"]))
+    def locked(path):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(index, "open_index", locked)
+    with pytest.raises(sqlite3.OperationalError):
+        index.connect(data_dir)
+    assert (data_dir / index.INDEX_NAME).exists()
+
+
+def test_records_without_writable_index(data_dir, monkeypatch):
+    def readonly(path):
+        raise sqlite3.OperationalError("unable to open database file")
+    monkeypatch.setattr(index, "open_index", readonly)
+    assert len(list(index.records(data_dir, types=["task"]))) == 2
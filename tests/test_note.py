@@ -0,0 +1,58 @@
+import sqlite3
+
+import pytest
+
+from notes import index, note
+from notes.note import by_id, fill_timestamp, grep_files, render_template
+
+
+def test_render_template(tmp_path):
+    template = tmp_path / "task.yaml"
+    template.write_text("event:\ntimestamp: {{ timestamp }}\ndate: {{date}}\n")
+    assert render_template(template, timestamp="T", date="D") == "event:\ntimestamp: T\ndate: D\n"
+    # Anything else is rendered by Jinja.
+    template.write_text("{% if date %}date: {{ date }}{% endif %}")
+    assert render_template(template, timestamp="T", date="D") == "date: D"
+
+
+def test_by_id_without_index(tmp_path, monkeypatch):
+    def broken_find(data_dir, id):
+        raise sqlite3.DatabaseError("file is not a database")
+    monkeypatch.setattr(index, "find", broken_find)
+    path = tmp_path / "2022" / "2022-05-03T00:22:58.845189-07:00-task.yaml"
+    path.parent.mkdir()
+    path.write_text("event: Task1\n")
+    assert by_id(tmp_path, "366f31655b") == path
+
+
+def test_fill_timestamp():
+    timestamp = "2022-05-03T00:22:58-07:00"
+    assert fill_timestamp("event:\ntimestamp: null\ntags: []\n", timestamp) == (
+        f"event:\ntimestamp: {timestamp}\ntags: []\n")
+    assert fill_timestamp("event:", timestamp) == f"event:\ntimestamp: {timestamp}\n"
+    assert fill_timestamp(f"event:\ntimestamp: {timestamp}\n", "later") == f"event:\ntimestamp: {timestamp}\n"
+
+
+@pytest.fixture
+def grep_dir(tmp_path):
+    # Hidden files are skipped, but the data directory itself may be hidden, as in ~/.notes.
+    data_dir = tmp_path / ".notes"
+    (data_dir / "2022").mkdir(parents=True)
+    (data_dir / "2022" / "match.yaml").write_text("event: Task1\n")
+    (data_dir / "2022" / "other.yaml").write_text("event: Task2\n")
+    (data_dir / "2022" / "empty.yaml").write_text("")
+    (data_dir / ".hidden.yaml").write_text("event: Task1\n")
+    (data_dir / ".git").mkdir()
+    (data_dir / ".git" / "hook.sample").write_text("Task1\n")
+    return data_dir
+
+
+def test_grep_files(grep_dir):
+    assert grep_files("Task1", grep_dir) == [grep_dir / "2022" / "match.yaml"]
+
+
+def test_grep_files_without_grep(grep_dir, monkeypatch):
+    def missing(command, **kwargs):
+        raise FileNotFoundError(command[0])
+    monkeypatch.setattr(note, "run", missing)
+    assert grep_files("Task1", grep_dir) == [grep_dir / "2022" / "match.yaml"]
@@ -1,6 +1,66 @@
 import datetime
-from notes.parser import parse_datetime_or_delta
+import pathlib
+
+from notes.parser import TIMEZONE, file_id, load_yaml, parse_datetime_or_delta, parse_record, read_markdown, read_records
 
 def test_parse_datetime_or_delta():
     assert parse_datetime_or_delta('next thursday', datetime.date(2022, 5, 3)) == datetime.date(2022, 5, 12)
     assert parse_datetime_or_delta('thursday', datetime.date(2022, 5, 3)) == datetime.date(2022, 5, 5)
+    assert parse_datetime_or_delta('Monday', datetime.date(2022, 5, 4)) == datetime.date(2022, 5, 2)
+    assert parse_datetime_or_delta('yesterday', datetime.date(2022, 5, 3)) == datetime.date(2022, 5, 2)
+    assert parse_datetime_or_delta('tomorrow', datetime.datetime(2022, 5, 3, 9, tzinfo=TIMEZONE)) == datetime.date(2022, 5, 4)
+
+
+
+def test_parse_deltas():
+    ts = datetime.datetime(2022, 5, 3, 9, tzinfo=TIMEZONE)
+    assert parse_datetime_or_delta('2 weeks', ts) == datetime.date(2022, 5, 17)
+    assert parse_datetime_or_delta('1 month', ts) == datetime.date(2022, 6, 3)
+    assert parse_datetime_or_delta('1 month', datetime.date(2022, 1, 31)) == datetime.date(2022, 2, 28)
+    assert parse_datetime_or_delta('1 year', datetime.date(2024, 2, 29)) == datetime.date(2025, 2, 28)
+    assert parse_datetime_or_delta('3 business days', ts) == datetime.date(2022, 5, 6)
+    assert parse_datetime_or_delta('5 hours', ts) == datetime.datetime(2022, 5, 3, 14, tzinfo=TIMEZONE)
+    assert parse_datetime_or_delta('never', ts) == datetime.date(2100, 1, 1)
+    assert parse_datetime_or_delta('2022-06-01', ts) == datetime.date(2022, 6, 1)
+    assert parse_datetime_or_delta('17:30', ts) == datetime.datetime(2022, 5, 3, 17, 30, tzinfo=TIMEZONE)
+    assert parse_datetime_or_delta('2022-06-01 12 am', ts) == datetime.datetime(2022, 6, 1, 0, tzinfo=TIMEZONE)
+    assert parse_datetime_or_delta('2022-06-01 03 pm', ts) == datetime.datetime(2022, 6, 1, 15, tzinfo=TIMEZONE)
+
+
+DATA_DIR = pathlib.Path(__file__).parent / "data" / "date-parsing" / "data"
+
+
+def test_load_yaml_keeps_times_of_day():
+    assert load_yaml("due: 12:30\nrank_priority: -1") == {"due": "12:30", "rank_priority": -1}
+
+
+def test_parse_record_created():
+    parsed = parse_record(DATA_DIR / "2022" / "2022-05-03T00:22:58.845189-07:00-task.yaml")
+    assert parsed.type == "task"
+    assert parsed.event == "Task1"
+    assert parsed.created == datetime.datetime(2022, 5, 3, 0, 22, 58, 845189, tzinfo=TIMEZONE)
+    assert parsed.due == datetime.date(2022, 5, 12)
+    assert parse_record(str(parsed.path)) == parsed
+
+
+def test_file_id():
+    name = "2022-05-03T00:22:58.845189-07:00-task.yaml"
+    assert file_id(name) == file_id(DATA_DIR / "2022" / name) == "366f31655b"
+
+
+def test_read_markdown():
+    note = b"# Title\n\n```python\n# comment\n```\n#### Metadata:\n```yaml\ntags: []\n```\n"
+    assert read_markdown(note) == ("Title", b"tags: []\n")
+    # Falls back to commonmark for other heading styles.
+    assert read_markdown(b"Title\n=====\n\n```yaml\ntags: []\n```\n") == ("Title", "tags: []\n")
+
+
+def test_read_records_markdown_fallback_in_threads(tmp_path):
+    # Enough notes to use the thread pool, all needing commonmark.
+    body = "\n".join(f"Line {i} with *emphasis* and `code`." for i in range(150))
+    paths = []
+    for i in range(40):
+        path = tmp_path / f"2022-05-03T00:00:{i:02}-07:00-note.md"
+        path.write_text(f"Title {i}\n=====\n\n{body}\n\n```yaml\nid: {i}\n```\n")
+        paths.append(path)
+    assert list(read_records(paths)) == [(f"Title {i}", {"id": i}) for i in range(40)]